@@ -1,15 +1,20 @@
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 from sqlalchemy import select, func
 from .models import Category, SubCategory, EnergyRecord
 
-def delete_record(db: Session, record_id: int) -> bool:
-    """Delete an energy record by ID. Returns True if deleted, False if not found."""
-    rec = db.scalar(select(EnergyRecord).where(EnergyRecord.id == record_id))
+def delete_record(db: Session, record_id: int):
+    """Delete an energy record by ID. Returns the deleted record (with its category
+    and subcategory loaded), or None if not found."""
+    rec = db.scalar(
+        select(EnergyRecord)
+        .options(joinedload(EnergyRecord.category), joinedload(EnergyRecord.subcategory))
+        .where(EnergyRecord.id == record_id)
+    )
     if not rec:
-        return False
+        return None
     db.delete(rec)
     db.commit()
-    return True
+    return rec
 
 def normalize_name(name: str) -> str:
     return " ".join(name.strip().split())
@@ -160,3 +165,39 @@ def get_stacked_yearly_series(db: Session):
         })
     
     return years, datasets
+
+def get_category_subcategory_breakdown(db: Session):
+    """Get yearly totals as { year: { category_name: { subcategory_name: value_kwh } } }"""
+    stmt = select(
+        EnergyRecord.year,
+        Category.name.label("category_name"),
+        SubCategory.name.label("subcategory_name"),
+        func.sum(EnergyRecord.value_kwh).label("total_kwh")
+    ).join(
+        Category, EnergyRecord.category_id == Category.id
+    ).join(
+        SubCategory, EnergyRecord.subcategory_id == SubCategory.id
+    ).group_by(
+        EnergyRecord.year, 
+        Category.name, 
+        SubCategory.name
+    ).order_by(
+        EnergyRecord.year.asc()
+    )
+    
+    rows = db.execute(stmt).all()
+    
+    result = {}
+    for row in rows:
+        year_str = str(row.year)
+        cat_name = row.category_name
+        subcat_name = row.subcategory_name
+        total_kwh = float(row.total_kwh) if row.total_kwh else 0.0
+        
+        if year_str not in result:
+            result[year_str] = {}
+        if cat_name not in result[year_str]:
+            result[year_str][cat_name] = {}
+        result[year_str][cat_name][subcat_name] = total_kwh
+    
+    return result
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event, text
+
+from .database import DATABASE_URL, IS_SQLITE, RoutingSession, SessionLocal
+from .models import EnergyRecord
+
+# "memory" : bus en mémoire (un seul processus / un seul nœud)
+# "postgres" : diffusion via LISTEN/NOTIFY (plusieurs workers ou nœuds)
+EVENT_BACKEND = os.getenv("EVENT_BACKEND", "memory")
+if IS_SQLITE:
+    EVENT_BACKEND = "memory"
+NOTIFY_CHANNEL = "energy_deltas"
+
+# Placé dans la file d'un abonné trop lent : ses deltas sont remplacés par un resync
+RESYNC = object()
+
+logger = logging.getLogger(__name__)
+
+
+def record_delta(rec, sign: int) -> dict:
+    """Build the dashboard delta for a record being added (sign=1) or removed (sign=-1)"""
+    return {
+        "year": rec.year,
+        "category_id": rec.category_id,
+        "category": rec.category.name if rec.category else None,
+        "subcategory": rec.subcategory.name if rec.subcategory else None,
+        "value_kwh": sign * float(rec.value_kwh),
+        "count": sign,
+    }
+
+
+class _SnapshotGate:
+    """Many commits at once, or one snapshot read with no commit in flight"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._writers = 0
+        self._snapshot = False
+
+    def enter_write(self):
+        with self._cond:
+            while self._snapshot:
+                self._cond.wait()
+            self._writers += 1
+
+    def exit_write(self):
+        with self._cond:
+            self._writers -= 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def snapshot(self):
+        with self._cond:
+            while self._snapshot:
+                self._cond.wait()
+            # Bloque les nouveaux commits, puis attend ceux en cours
+            self._snapshot = True
+            while self._writers:
+                self._cond.wait()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._snapshot = False
+                self._cond.notify_all()
+
+
+class EventBus:
+    """Fan-out of numbered dashboard deltas to the open SSE streams of this process"""
+
+    def __init__(self):
+        self._subscribers: set[tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = set()
+        self._lock = threading.Lock()
+        # Numéro du dernier delta diffusé
+        self.seq = 0
+        self.gate = _SnapshotGate()
+
+    def subscribe(self) -> tuple[asyncio.AbstractEventLoop, asyncio.Queue]:
+        sub = (asyncio.get_running_loop(), asyncio.Queue(maxsize=100))
+        with self._lock:
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def dispatch(self, delta: dict):
+        # Appelé depuis le threadpool (routes sync) ou le thread LISTEN
+        # Sous le verrou pour que chaque file reçoive les deltas dans l'ordre des numéros
+        with self._lock:
+            self.seq += 1
+            for loop, queue in self._subscribers:
+                loop.call_soon_threadsafe(_put_nowait, queue, (self.seq, delta))
+
+    def resync_all(self):
+        """Ask every open stream to reload the aggregates"""
+        with self._lock:
+            for loop, queue in self._subscribers:
+                loop.call_soon_threadsafe(_force_resync, queue)
+
+
+def _put_nowait(queue: asyncio.Queue, item):
+    # Un client trop lent reçoit un resync plutôt que de faire grossir la mémoire
+    try:
+        queue.put_nowait(item)
+    except asyncio.QueueFull:
+        _force_resync(queue)
+
+
+def _force_resync(queue: asyncio.Queue):
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(RESYNC)
+
+
+# ---------- Capture des deltas dans la transaction d'écriture ----------
+@event.listens_for(RoutingSession, "after_flush")
+def _collect_deltas(session, flush_context):
+    deltas = [record_delta(obj, 1) for obj in session.new if isinstance(obj, EnergyRecord)]
+    deltas += [record_delta(obj, -1) for obj in session.deleted if isinstance(obj, EnergyRecord)]
+    if not deltas:
+        return
+
+    if EVENT_BACKEND == "postgres":
+        # NOTIFY est transactionnel : délivré au commit, abandonné au rollback.
+        # Le xid permet à un resync de savoir si son snapshot contient déjà le delta.
+        xid = int(session.execute(text("SELECT pg_current_xact_id()::text")).scalar())
+        for delta in deltas:
+            session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                            {"channel": NOTIFY_CHANNEL, "payload": json.dumps({**delta, "xid": xid})})
+        return
+
+    # Du flush jusqu'à la diffusion, aucun snapshot ne peut être lu
+    if not session.info.get("dashboard_gate"):
+        bus.gate.enter_write()
+        session.info["dashboard_gate"] = True
+    session.info.setdefault("dashboard_deltas", []).extend(deltas)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _dispatch_deltas(session):
+    for delta in session.info.pop("dashboard_deltas", []):
+        bus.dispatch(delta)
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _release_gate(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("dashboard_deltas", None)
+        if session.info.pop("dashboard_gate", False):
+            bus.gate.exit_write()
+
+
+# ---------- Snapshot cohérent avec le flux ----------
+def _parse_pg_snapshot(snapshot: str):
+    xmin, xmax, xip = snapshot.split(":")
+    return int(xmin), int(xmax), {int(x) for x in xip.split(",") if x}
+
+
+def consistent_snapshot(read):
+    """Run read(db) and return (result, included).
+
+    included(seq, delta) tells whether a queued delta is already counted in
+    result, so a stream can forward exactly the deltas that follow it.
+    """
+    db = SessionLocal()
+    try:
+        if EVENT_BACKEND == "postgres":
+            db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+            snapshot = db.execute(text("SELECT pg_current_snapshot()::text")).scalar()
+            result = read(db)
+            xmin, xmax, xip = _parse_pg_snapshot(snapshot)
+            return result, lambda seq, delta: delta["xid"] < xmin or (delta["xid"] < xmax and delta["xid"] not in xip)
+
+        # Connexion prise avant de bloquer les commits : pas d'attente croisée sur le pool
+        db.connection()
+        with bus.gate.snapshot():
+            seq = bus.seq
+            result = read(db)
+        return result, lambda s, delta: s <= seq
+    finally:
+        db.close()
+
+
+# ---------- PostgreSQL LISTEN ----------
+def _pg_dsn() -> str:
+    return DATABASE_URL.replace("postgresql+psycopg://", "postgresql://", 1)
+
+
+def _listen_forever():
+    import psycopg
+
+    while True:
+        try:
+            with psycopg.connect(_pg_dsn(), autocommit=True) as conn:
+                conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                # Les NOTIFY émis pendant une coupure sont perdus : tous les flux se resynchronisent
+                bus.resync_all()
+                for notify in conn.notifies():
+                    bus.dispatch(json.loads(notify.payload))
+        except Exception:
+            logger.exception("LISTEN %s interrompu, nouvelle tentative dans 2 s", NOTIFY_CHANNEL)
+            time.sleep(2)
+
+
+def start_listener():
+    """Start the LISTEN thread when deltas are shared through PostgreSQL"""
+    if EVENT_BACKEND != "postgres":
+        return
+    threading.Thread(target=_listen_forever, name="energy-listen", daemon=True).start()
+
+
+bus = EventBus()
@@ -1,12 +1,15 @@
 from fastapi import FastAPI, Request, Depends, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from fastapi import Query
+import asyncio
+import json
 
 from .database import Base, engine, get_db
-from . import crud
+from . import crud, events, profiling
 
 # Create tables (simple setup for test technique)
 Base.metadata.create_all(bind=engine)
@@ -152,9 +155,36 @@ app = FastAPI(
             "name": "Dashboard",
             "description": "Données agrégées pour la visualisation"
         },
+        {
+            "name": "Profilage",
+            "description": "Profils des requêtes lentes ou demandées (en-tête X-Profile)"
+        },
     ]
 )
 
+if profiling.ENABLED:
+    # Les routes déclarées ensuite exposent leur thread au profileur
+    app.router.route_class = profiling.ProfiledRoute
+
+@app.on_event("startup")
+def start_event_listener():
+    events.start_listener()
+
+async def profile_request(request: Request, call_next):
+    prof = profiling.begin(request)
+    if prof is None:
+        return await call_next(request)
+    response = None
+    try:
+        response = await call_next(request)
+    finally:
+        profiling.end(prof, response)
+    return response
+
+# BaseHTTPMiddleware enveloppe chaque réponse (flux SSE compris) : seulement si le profilage est actif
+if profiling.ENABLED:
+    app.middleware("http")(profile_request)
+
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
@@ -377,42 +407,113 @@ def api_category_subcategory_breakdown(db: Session = Depends(get_db)):
     
     **Réponse** : Structure imbriquée { year: { category: { subcategory: value_kwh } } }
     """
-    from sqlalchemy import select, func
-    from .models import Category, SubCategory, EnergyRecord
+    return crud.get_category_subcategory_breakdown(db)
+
+def dashboard_snapshot(category_id: int | None = None):
+    """Aggregates sent with a `resync` event (KPIs filtered like /dashboard)"""
+    def read(db: Session):
+        total, avg, count = crud.get_dashboard_stats(db, category_id=category_id)
+        breakdown = crud.get_category_subcategory_breakdown(db)
+        return {"total": total, "count": count, "breakdown": breakdown}
+
+    return events.consistent_snapshot(read)
+
+@app.get("/api/dashboard/stream", tags=["Dashboard"])
+async def api_dashboard_stream(request: Request, category_id: int | None = None):
+    """
+    Flux Server-Sent Events des modifications du dashboard.
     
-    stmt = select(
-        EnergyRecord.year,
-        Category.name.label("category_name"),
-        SubCategory.name.label("subcategory_name"),
-        func.sum(EnergyRecord.value_kwh).label("total_kwh")
-    ).join(
-        Category, EnergyRecord.category_id == Category.id
-    ).join(
-        SubCategory, EnergyRecord.subcategory_id == SubCategory.id
-    ).group_by(
-        EnergyRecord.year, 
-        Category.name, 
-        SubCategory.name
-    ).order_by(
-        EnergyRecord.year.asc()
-    )
+    À la connexion, un événement `resync` contient les agrégats complets.
+    Ensuite, un événement `delta` est envoyé après chaque création ou suppression d'enregistrement.
+    Aucune requête SQL n'est exécutée entre deux écritures.
     
-    rows = db.execute(stmt).all()
+    Chaque événement porte un `id:` croissant. Un client trop lent reçoit un nouveau `resync`
+    au lieu des deltas qu'il n'a pas pu lire.
     
-    result = {}
-    for row in rows:
-        year_str = str(row.year)
-        cat_name = row.category_name
-        subcat_name = row.subcategory_name
-        total_kwh = float(row.total_kwh) if row.total_kwh else 0.0
-        
-        if year_str not in result:
-            result[year_str] = {}
-        if cat_name not in result[year_str]:
-            result[year_str][cat_name] = {}
-        result[year_str][cat_name][subcat_name] = total_kwh
+    **Paramètres** :
+    - `category_id` (optionnel) : filtre des KPI, comme `/dashboard`
+    
+    **resync** : `{ total, count, breakdown }` (`breakdown` au format de `/api/category-subcategory-breakdown`)
     
-    return result
+    **delta** : `{ year, category_id, category, subcategory, value_kwh, count }`
+    (`value_kwh` et `count` sont négatifs pour une suppression)
+    """
+    async def stream():
+        # Abonnement avant la lecture des agrégats : aucun delta ne peut être perdu entre les deux
+        sub = events.bus.subscribe()
+        queue = sub[1]
+        event_id = 0
+        try:
+            yield "retry: 5000\n\n"
+            snapshot, included = await run_in_threadpool(dashboard_snapshot, category_id)
+            yield f"id: {event_id}\nevent: resync\ndata: {json.dumps(snapshot)}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # keep-alive pour les proxys
+                    yield ": ping\n\n"
+                    continue
+                if item is events.RESYNC:
+                    snapshot, included = await run_in_threadpool(dashboard_snapshot, category_id)
+                    event_id += 1
+                    yield f"id: {event_id}\nevent: resync\ndata: {json.dumps(snapshot)}\n\n"
+                    continue
+                seq, delta = item
+                if included(seq, delta):
+                    # déjà compté dans le dernier resync
+                    continue
+                delta = {k: v for k, v in delta.items() if k != "xid"}
+                event_id += 1
+                yield f"id: {event_id}\nevent: delta\ndata: {json.dumps(delta)}\n\n"
+        finally:
+            events.bus.unsubscribe(sub)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ---------- Profilage (protégé par l'en-tête X-Profile) ----------
+def require_profile_token(request: Request):
+    if not profiling.is_authorized(request):
+        raise HTTPException(status_code=404, detail="Profilage désactivé ou jeton invalide.")
+
+@app.get("/api/profiles", tags=["Profilage"], dependencies=[Depends(require_profile_token)])
+def api_list_profiles():
+    """
+    Liste les profils conservés dans le tampon circulaire (plus récent en premier).
+    
+    Un profil est conservé s'il a été demandé via l'en-tête `X-Profile`,
+    ou si une requête échantillonnée dépasse `PROFILE_SLOW_MS`.
+    """
+    return [p.summary() for p in profiling.list_profiles()]
+
+@app.get("/api/profiles/{profile_id}", tags=["Profilage"], dependencies=[Depends(require_profile_token)])
+def api_get_profile(profile_id: int):
+    """
+    Détail d'un profil : durée, requêtes SQL et temps estimé par phase
+    (`sql`, `orm`, `serialization`, `template`, `other`).
+    """
+    prof = profiling.get_profile(profile_id)
+    if not prof:
+        raise HTTPException(status_code=404, detail="Profil introuvable.")
+    return prof.detail()
+
+@app.get("/api/profiles/{profile_id}/folded", tags=["Profilage"], dependencies=[Depends(require_profile_token)])
+def api_download_profile(profile_id: int):
+    """
+    Télécharge le profil au format « folded stacks », lisible par
+    flamegraph.pl, speedscope ou inferno.
+    """
+    prof = profiling.get_profile(profile_id)
+    if not prof:
+        raise HTTPException(status_code=404, detail="Profil introuvable.")
+    return PlainTextResponse(
+        prof.folded(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{prof.id}.folded"'},
+    )
 
 @app.post("/records/{record_id}/delete")
 def delete_record(
@@ -421,8 +522,8 @@ def delete_record(
     year: str | None = Form(default=None),
     db: Session = Depends(get_db),
 ):
-    ok = crud.delete_record(db, record_id=record_id)
-    if not ok:
+    rec = crud.delete_record(db, record_id=record_id)
+    if not rec:
         raise HTTPException(status_code=404, detail="Enregistrement introuvable.")
 
     url = "/list"
@@ -0,0 +1,232 @@
+import functools
+import hmac
+import inspect
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Profilage à la demande : en-tête X-Profile = PROFILE_TOKEN, ou échantillonnage
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "500"))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "50"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+# Sans jeton ni échantillonnage, ni middleware ni enveloppe de route ne sont installés
+ENABLED = bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+PROFILE_HEADER = "X-Profile"
+# Consulter les profils ne doit pas en créer de nouveaux dans le tampon
+PROFILE_API_PREFIX = "/api/profiles"
+PHASES = ("sql", "orm", "serialization", "template", "other")
+
+_APP_DIR = os.path.dirname(os.path.abspath(__file__))
+_current: ContextVar["RequestProfile | None"] = ContextVar("current_profile", default=None)
+_ids = itertools.count(1)
+
+
+def _phase_of(filename: str) -> str | None:
+    path = filename.replace("\\", "/")
+    if any(p in path for p in ("sqlalchemy/engine", "sqlalchemy/pool", "sqlalchemy/dialects", "psycopg", "sqlite3")):
+        return "sql"
+    if "sqlalchemy/" in path:
+        return "orm"
+    if "jinja2/" in path or path.endswith(".html"):
+        return "template"
+    if path.startswith(_APP_DIR) and not path.endswith(("database.py", "profiling.py")):
+        return "serialization"
+    return None
+
+
+class RequestProfile:
+    """Stack samples and SQL timings collected for one request"""
+
+    def __init__(self, method: str, url: str, reason: str):
+        self.id = next(_ids)
+        self.method = method
+        self.url = url
+        self.reason = reason
+        self.started_at = time.time()
+        self.duration_ms = 0.0
+        self.status_code = None
+        self.sql_count = 0
+        self.sql_ms = 0.0
+        self.phases = Counter()
+        self.stacks = Counter()
+        self.threads: set[int] = set()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name=f"profile-{self.id}", daemon=True)
+
+    def start(self):
+        self._start = time.perf_counter()
+        self._sampler.start()
+
+    def stop(self, status_code: int):
+        self._stop.set()
+        self._sampler.join()
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+        self.status_code = status_code
+
+    def _sample(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        while not self._stop.wait(interval):
+            frames = sys._current_frames()
+            for ident in list(self.threads):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self._record(frame)
+
+    def _record(self, frame):
+        stack = []
+        phase = None
+        in_app = False
+        while frame is not None:
+            code = frame.f_code
+            filename = code.co_filename
+            stack.append(f"{code.co_name} ({os.path.basename(filename)}:{frame.f_lineno})")
+            frame_phase = _phase_of(filename)
+            if phase is None:
+                phase = frame_phase
+            in_app = in_app or frame_phase == "serialization"
+            frame = frame.f_back
+        # Thread du pool inactif ou occupé par une autre tâche
+        if not in_app:
+            return
+        self.phases[phase or "other"] += 1
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "url": self.url,
+            "reason": self.reason,
+            "status_code": self.status_code,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 2),
+        }
+
+    def detail(self) -> dict:
+        return {
+            **self.summary(),
+            "sql_count": self.sql_count,
+            "sql_ms": round(self.sql_ms, 2),
+            "samples": sum(self.phases.values()),
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "phases_ms": {p: self.phases[p] * PROFILE_INTERVAL_MS for p in PHASES},
+        }
+
+    def folded(self) -> str:
+        """Collapsed stacks (flamegraph.pl, speedscope, inferno)"""
+        root = f"{self.method} {self.url}".replace(";", ",")
+        return "".join(f"{root};{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+# Tampon circulaire des profils conservés (rempli par la boucle, lu depuis le threadpool)
+profiles: deque[RequestProfile] = deque(maxlen=PROFILE_BUFFER_SIZE)
+_profiles_lock = threading.Lock()
+
+
+def is_authorized(request) -> bool:
+    token = request.headers.get(PROFILE_HEADER, "")
+    # Comparaison en octets : compare_digest refuse les str non ASCII
+    return bool(PROFILE_TOKEN) and hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+
+def begin(request) -> RequestProfile | None:
+    """Start profiling the request if it carries the token or is sampled"""
+    if request.url.path.startswith(PROFILE_API_PREFIX):
+        return None
+    if is_authorized(request):
+        reason = "header"
+    elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        reason = "sampled"
+    else:
+        return None
+    url = request.url.path + (f"?{request.url.query}" if request.url.query else "")
+    prof = RequestProfile(request.method, url, reason)
+    _current.set(prof)
+    prof.start()
+    return prof
+
+
+def end(prof: RequestProfile, response):
+    """Stop profiling and keep the profile if it was requested or is slow.
+
+    `response` is None when the route raised: the profile is recorded as a 500.
+    """
+    prof.stop(response.status_code if response is not None else 500)
+    _current.set(None)
+    kept = prof.reason == "header" or prof.duration_ms >= PROFILE_SLOW_MS or response is None
+    if kept:
+        with _profiles_lock:
+            profiles.append(prof)
+    if response is not None:
+        if kept:
+            response.headers["X-Profile-Id"] = str(prof.id)
+        response.headers["Server-Timing"] = f"sql;dur={prof.sql_ms:.1f}, total;dur={prof.duration_ms:.1f}"
+
+
+def list_profiles() -> list[RequestProfile]:
+    """Kept profiles, most recent first"""
+    with _profiles_lock:
+        return list(reversed(profiles))
+
+
+def get_profile(profile_id: int) -> RequestProfile | None:
+    with _profiles_lock:
+        return next((p for p in profiles if p.id == profile_id), None)
+
+
+def _sampled(endpoint):
+    """Register the threadpool thread running a sync endpoint with the current profile.
+
+    Async endpoints run on the event loop thread, shared with every other
+    request: sampling it would mix their coroutines into this profile, so
+    those routes only get SQL timings.
+    """
+    if inspect.iscoroutinefunction(endpoint):
+        return endpoint
+
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        prof = _current.get()
+        if prof is None:
+            return endpoint(*args, **kwargs)
+        ident = threading.get_ident()
+        prof.threads.add(ident)
+        try:
+            return endpoint(*args, **kwargs)
+        finally:
+            prof.threads.discard(ident)
+    return wrapper
+
+
+class ProfiledRoute(APIRoute):
+    """Route whose endpoint thread is sampled when the request is profiled"""
+
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, _sampled(endpoint), **kwargs)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    prof = _current.get()
+    if prof is not None:
+        conn.info.setdefault("profile_t0", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    prof = _current.get()
+    if prof is not None and conn.info.get("profile_t0"):
+        prof.sql_count += 1
+        prof.sql_ms += (time.perf_counter() - conn.info["profile_t0"].pop()) * 1000